@@ -1,15 +1,23 @@
 """MCP server for DICOM image downloading."""
 
 import os
+import re
 import sys
 import json
 import asyncio
+import hashlib
+import struct
+import zlib
+import multiprocessing
+import time
+import shutil
 import tempfile
 import subprocess
 from pathlib import Path
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
 from typing import Optional, Union, Dict
 from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
 
 from mcp.server.fastmcp import FastMCP
 from pydantic import BaseModel, Field
@@ -74,6 +82,24 @@ mcp = FastMCP("dicom-downloader")
 _DEFAULT_OUTPUT_DIR = os.getenv("DICOM_DEFAULT_OUTPUT_DIR", "./dicom_downloads")
 _DEFAULT_MAX_ROUNDS = int(os.getenv("DICOM_DEFAULT_MAX_ROUNDS", "3"))
 _DEFAULT_STEP_WAIT_MS = int(os.getenv("DICOM_DEFAULT_STEP_WAIT_MS", "40"))
+_DEFAULT_DEDUP = os.getenv("DICOM_DEFAULT_DEDUP", "false").lower() in ("1", "true", "yes")
+
+# 跨检查去重存储目录名（位于 output_parent 下）
+_DEDUP_STORE_DIRNAME = ".dicom_store"
+# SOP Instance UID 来自下载的文件头，仅在格式合法时用于存储文件名
+_SOP_UID_PATTERN = re.compile(r"^[0-9.]{1,64}$")
+
+_DEFAULT_PREVIEW = os.getenv("DICOM_DEFAULT_PREVIEW", "true").lower() in ("1", "true", "yes")
+_PREVIEW_THUMB_SIZE = 256  # 缩略图最长边（像素）
+_PREVIEW_MONTAGE_COLS = 4
+
+# 批量计划：历史耗时文件（位于 output_parent 下）及无历史时的默认估计（秒/链接）
+_TIMINGS_FILENAME = ".dicom_timings.json"
+_DEFAULT_PROVIDER_COST_SECONDS = {"cloud": 60.0, "nyfy": 90.0, "fz": 120.0, "tz": 180.0}
+# 分享链接中常见的过期时间参数名（Unix 秒或毫秒）
+_EXPIRY_QUERY_KEYS = ("expires", "expire", "expireTime", "expire_time", "expiredTime", "exp", "deadline")
+# 合理的过期时间范围（Unix 秒，2001-09 至 2286-11），范围外视为非时间戳
+_EXPIRY_EPOCH_RANGE = (1e9, 1e10)
 
 
 # ============================================================================
@@ -114,6 +140,14 @@ class DownloadRequest(BaseModel):
         default=_DEFAULT_STEP_WAIT_MS,
         description="Delay between steps in milliseconds (延迟时间，默认 40ms)",
     )
+    dedup: bool = Field(
+        default=_DEFAULT_DEDUP,
+        description="Reflink/hard-link repeated instances into a shared store (跨检查去重，默认关闭)",
+    )
+    generate_preview: bool = Field(
+        default=_DEFAULT_PREVIEW,
+        description="Render per-series key-image thumbnails and a montage PNG (预览图，默认开启)",
+    )
 
 
 class BatchDownloadRequest(BaseModel):
@@ -152,6 +186,18 @@ class BatchDownloadRequest(BaseModel):
         default=_DEFAULT_STEP_WAIT_MS,
         description="Delay between steps in milliseconds (延迟时间，默认 40ms)",
     )
+    dedup: bool = Field(
+        default=_DEFAULT_DEDUP,
+        description="Reflink/hard-link repeated instances into a shared store (跨检查去重，默认关闭)",
+    )
+    generate_preview: bool = Field(
+        default=_DEFAULT_PREVIEW,
+        description="Render per-series key-image thumbnails and a montage PNG (预览图，默认开启)",
+    )
+    expires_at: Optional[Dict[str, float]] = Field(
+        default=None,
+        description="URL到过期时间(Unix 秒)的映射，用于优先下载即将过期的链接；未提供时尝试从URL参数识别",
+    )
 
 
 class DownloadResult(BaseModel):
@@ -163,6 +209,42 @@ class DownloadResult(BaseModel):
     zip_path: Optional[str] = Field(default=None, description="Path to ZIP file if created")
     message: str = Field(description="Status message or error details")
     file_count: Optional[int] = Field(default=None, description="Number of files downloaded")
+    deduplicated_count: Optional[int] = Field(
+        default=None, description="Number of files replaced by links into the shared store"
+    )
+    preview_paths: Optional[list[str]] = Field(
+        default=None, description="Per-series key-image thumbnail PNG paths"
+    )
+    montage_path: Optional[str] = Field(
+        default=None, description="Path to montage PNG combining all series thumbnails"
+    )
+
+
+class BatchPlanItem(BaseModel):
+    """One URL in an execution plan."""
+
+    order: int = Field(description="Execution position (1-based)")
+    url: str = Field(description="Source URL")
+    provider: str = Field(description="Detected or requested provider")
+    share_id: str = Field(description="Share identifier (output subdirectory name)")
+    estimated_seconds: float = Field(description="Estimated download time from historical timings")
+    expires_at: Optional[float] = Field(
+        default=None, description="Link expiry as Unix timestamp, if known"
+    )
+
+
+class BatchPlan(BaseModel):
+    """Execution plan for a batch download."""
+
+    items: list[BatchPlanItem] = Field(description="URLs in execution order")
+    duplicates: list[str] = Field(
+        default_factory=list, description="URLs skipped because their share_id is already planned"
+    )
+    expired: list[str] = Field(
+        default_factory=list, description="Planned URLs whose link has already expired (run last)"
+    )
+    providers: Dict[str, int] = Field(description="Number of planned URLs per provider")
+    estimated_total_seconds: float = Field(description="Sum of per-URL estimates")
 
 
 class ProviderInfo(BaseModel):
@@ -220,6 +302,575 @@ def count_files_recursive(directory: str) -> int:
     return count
 
 
+# ============================================================================
+# Cross-study Deduplication Store
+# ============================================================================
+
+
+def _read_sop_instance_uid(file_path: str) -> Optional[str]:
+    """Read SOP Instance UID from a DICOM header, or None for non-DICOM files."""
+    try:
+        import pydicom
+
+        ds = pydicom.dcmread(
+            file_path, stop_before_pixels=True, specific_tags=["SOPInstanceUID"]
+        )
+        uid = getattr(ds, "SOPInstanceUID", None)
+        return str(uid) if uid else None
+    except Exception:
+        return None
+
+
+def _hash_file(file_path: str) -> str:
+    """Compute SHA-256 of file content."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """
+    Create dst as a copy-on-write clone of src (Linux FICLONE ioctl).
+
+    Returns False when the platform or filesystem does not support reflinks,
+    leaving no dst behind.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    ficlone = 0x40049409
+    try:
+        with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+            fcntl.ioctl(dst_f.fileno(), ficlone, src_f.fileno())
+        return True
+    except OSError:
+        try:
+            os.unlink(dst)
+        except OSError:
+            pass
+        return False
+
+
+def _link_from_blob(blob_path: str, dst: str) -> None:
+    """Create dst from a blob: reflink if possible, otherwise a read-only hard-link."""
+    if _reflink(blob_path, dst):
+        return
+    # 硬链接共享 inode：保持只读，避免原地写入同时改坏所有检查
+    os.chmod(blob_path, 0o444)
+    os.link(blob_path, dst)
+
+
+def _read_refs(refs_path: str) -> set[str]:
+    """Read the study files recorded as referencing a blob."""
+    try:
+        with open(refs_path, "r", encoding="utf-8") as f:
+            return {line.strip() for line in f if line.strip()}
+    except OSError:
+        return set()
+
+
+def _write_refs(refs_path: str, refs: set[str]) -> None:
+    """Write the study files referencing a blob."""
+    with open(refs_path, "w", encoding="utf-8") as f:
+        f.writelines(f"{ref}\n" for ref in sorted(refs))
+
+
+def dedup_into_store(directory: str, store_dir: str) -> int:
+    """
+    Replace files in directory with reflinks or hard-links into a content-addressed store.
+
+    Blobs are keyed by SOP Instance UID plus SHA-256 so identical instances
+    shared between studies are stored once; UIDs that are not well-formed
+    are left out of the key. The first sighting of an instance is copied
+    into the store, leaving the study file untouched. Later duplicates are
+    replaced by a reflink (copy-on-write) or, failing that, a hard-link to
+    the read-only blob. Each blob keeps a ``.refs`` file listing the study
+    files built from it. Returns the number of files that were replaced
+    from an existing blob.
+
+    说明：硬链接不支持跨文件系统，失败时保留原文件。
+    """
+    replaced = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            file_path = os.path.join(root, name)
+            try:
+                if os.path.islink(file_path):
+                    continue
+                content_hash = _hash_file(file_path)
+                uid = _read_sop_instance_uid(file_path)
+                if uid and _SOP_UID_PATTERN.match(uid):
+                    key = f"{uid}_{content_hash[:16]}"
+                else:
+                    key = content_hash
+                blob_dir = os.path.join(store_dir, content_hash[:2])
+                blob_path = os.path.join(blob_dir, key)
+                refs_path = f"{blob_path}.refs"
+                abs_path = os.path.abspath(file_path)
+                refs = _read_refs(refs_path)
+
+                if not os.path.exists(blob_path):
+                    # 首次出现：复制到存储，不与检查目录中的文件共享 inode
+                    os.makedirs(blob_dir, exist_ok=True)
+                    tmp_blob = f"{blob_path}.tmp"
+                    if not _reflink(file_path, tmp_blob):
+                        shutil.copyfile(file_path, tmp_blob)
+                    os.chmod(tmp_blob, 0o444)
+                    os.replace(tmp_blob, blob_path)
+                elif abs_path not in refs and not os.path.samefile(file_path, blob_path):
+                    # 已有相同实例：用存储中的副本替换重复文件
+                    tmp_path = f"{file_path}.dedup-tmp"
+                    _link_from_blob(blob_path, tmp_path)
+                    os.replace(tmp_path, file_path)
+                    replaced += 1
+
+                if abs_path not in refs:
+                    _write_refs(refs_path, refs | {abs_path})
+            except OSError as e:
+                print(f"[dedup] 跳过 {file_path}: {e}", file=sys.stderr)
+    return replaced
+
+
+def gc_dedup_store(store_dir: str) -> int:
+    """
+    Remove blobs no longer referenced by any study directory.
+
+    A blob is referenced while another hard-link to it exists or a study
+    file recorded in its ``.refs`` still exists with the same size.
+    Returns the number of removed blobs.
+    """
+    removed = 0
+    if not os.path.isdir(store_dir):
+        return removed
+    for root, dirs, files in os.walk(store_dir):
+        for name in files:
+            if name.endswith(".refs"):
+                continue
+            blob_path = os.path.join(root, name)
+            refs_path = f"{blob_path}.refs"
+            try:
+                blob_stat = os.stat(blob_path)
+                live_refs = set()
+                for ref in _read_refs(refs_path):
+                    try:
+                        if os.stat(ref).st_size == blob_stat.st_size:
+                            live_refs.add(ref)
+                    except OSError:
+                        pass
+                if blob_stat.st_nlink > 1 or live_refs:
+                    _write_refs(refs_path, live_refs)
+                    continue
+                os.unlink(blob_path)
+                if os.path.exists(refs_path):
+                    os.unlink(refs_path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+# ============================================================================
+# Series Previews (thumbnails + montage)
+# ============================================================================
+
+
+def _write_png(file_path: str, image) -> None:
+    """Write a 2-D uint8 NumPy array as an 8-bit grayscale PNG."""
+    import numpy as np
+
+    height, width = image.shape
+    # 每行前加滤波类型字节 0（None）
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), image]).tobytes()
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        crc = zlib.crc32(tag + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+    with open(file_path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def _first_value(value, default: float) -> float:
+    """Return the first element of a (possibly multi-valued) DICOM number."""
+    if value is None:
+        return default
+    try:
+        return float(value[0])
+    except (TypeError, IndexError):
+        return float(value)
+
+
+def _render_thumbnail(file_path: str, out_path: str, size: int):
+    """
+    Decode one instance, apply windowing and save a thumbnail PNG.
+
+    Runs in a worker process. Returns the 8-bit thumbnail array so the
+    montage can be assembled without decoding the instance again.
+    """
+    import numpy as np
+    import pydicom
+
+    ds = pydicom.dcmread(file_path)
+    pixels = ds.pixel_array
+    if int(getattr(ds, "NumberOfFrames", 1) or 1) > 1:
+        pixels = pixels[len(pixels) // 2]
+    if int(getattr(ds, "SamplesPerPixel", 1) or 1) > 1:
+        pixels = pixels.mean(axis=-1)
+
+    pixels = pixels.astype(np.float32)
+    pixels = pixels * _first_value(getattr(ds, "RescaleSlope", None), 1.0)
+    pixels = pixels + _first_value(getattr(ds, "RescaleIntercept", None), 0.0)
+
+    if getattr(ds, "WindowCenter", None) is not None and getattr(ds, "WindowWidth", None):
+        center = _first_value(ds.WindowCenter, 0.0)
+        width = _first_value(ds.WindowWidth, 1.0)
+        low, high = center - width / 2, center + width / 2
+    else:
+        low, high = np.percentile(pixels, (0.5, 99.5))
+
+    image = np.clip((pixels - low) / max(float(high - low), 1e-6), 0.0, 1.0) * 255.0
+    if getattr(ds, "PhotometricInterpretation", "") == "MONOCHROME1":
+        image = 255.0 - image
+
+    step = max(1, -(-max(image.shape) // size))
+    image = np.rint(np.ascontiguousarray(image[::step, ::step])).astype(np.uint8)
+    _write_png(out_path, image)
+    return image
+
+
+def _collect_series_key_images(directory: str) -> list[str]:
+    """
+    Group instances by series using headers only and pick one key image each.
+
+    The key image is the middle instance by InstanceNumber, so only one
+    instance per series has its pixel data decoded.
+    """
+    import pydicom
+
+    series: Dict[str, list[tuple[int, str]]] = {}
+    series_order: Dict[str, tuple[int, str]] = {}
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            try:
+                ds = pydicom.dcmread(
+                    file_path,
+                    stop_before_pixels=True,
+                    specific_tags=["SeriesInstanceUID", "SeriesNumber", "InstanceNumber"],
+                )
+            except Exception:
+                continue
+            uid = str(getattr(ds, "SeriesInstanceUID", "") or root)
+            instance_number = int(getattr(ds, "InstanceNumber", 0) or 0)
+            series.setdefault(uid, []).append((instance_number, file_path))
+            series_order.setdefault(uid, (int(getattr(ds, "SeriesNumber", 0) or 0), uid))
+
+    key_images = []
+    for uid in sorted(series, key=lambda u: series_order[u]):
+        instances = sorted(series[uid])
+        key_images.append(instances[len(instances) // 2][1])
+    return key_images
+
+
+def _build_montage(thumbnails: list, out_path: str, size: int) -> None:
+    """Tile thumbnails into a single grid PNG."""
+    import numpy as np
+
+    cols = min(_PREVIEW_MONTAGE_COLS, len(thumbnails))
+    rows = -(-len(thumbnails) // cols)
+    canvas = np.zeros((rows * size, cols * size), dtype=np.uint8)
+    for idx, thumb in enumerate(thumbnails):
+        top, left = (idx // cols) * size, (idx % cols) * size
+        h, w = thumb.shape
+        canvas[top:top + h, left:left + w] = thumb
+    _write_png(out_path, canvas)
+
+
+async def generate_previews(
+    directory: str,
+    preview_dir: str,
+    pool: Optional[ProcessPoolExecutor] = None,
+    size: int = _PREVIEW_THUMB_SIZE,
+) -> tuple[list[str], Optional[str]]:
+    """
+    Render per-series key-image thumbnails and a montage for a study.
+
+    Decoding and windowing run on the given process pool; studies with at
+    most two series (or no pool) are rendered inline in a worker thread.
+    preview_dir is recreated so previews of an earlier download do not
+    linger. Returns (thumbnail_paths, montage_path); montage_path is None
+    if nothing rendered.
+    """
+    key_images = await asyncio.to_thread(_collect_series_key_images, directory)
+    await asyncio.to_thread(shutil.rmtree, preview_dir, ignore_errors=True)
+    if not key_images:
+        return [], None
+
+    os.makedirs(preview_dir, exist_ok=True)
+    out_paths = [
+        os.path.join(preview_dir, f"series_{idx:03d}.png")
+        for idx in range(1, len(key_images) + 1)
+    ]
+
+    if pool is None or len(key_images) <= 2:
+        def render_inline() -> list:
+            rendered = []
+            for src, dst in zip(key_images, out_paths):
+                try:
+                    rendered.append(_render_thumbnail(src, dst, size))
+                except Exception as e:
+                    rendered.append(e)
+            return rendered
+
+        rendered = await asyncio.to_thread(render_inline)
+    else:
+        loop = asyncio.get_running_loop()
+        rendered = await asyncio.gather(
+            *[
+                loop.run_in_executor(pool, _render_thumbnail, src, dst, size)
+                for src, dst in zip(key_images, out_paths)
+            ],
+            return_exceptions=True,
+        )
+
+    thumbnail_paths = []
+    thumbnails = []
+    for src, dst, thumb in zip(key_images, out_paths, rendered):
+        if isinstance(thumb, BaseException):
+            print(f"[preview] 跳过 {src}: {thumb}", file=sys.stderr)
+            continue
+        thumbnail_paths.append(dst)
+        thumbnails.append(thumb)
+
+    if not thumbnails:
+        return [], None
+
+    montage_path = os.path.join(preview_dir, "montage.png")
+    await asyncio.to_thread(_build_montage, thumbnails, montage_path, size)
+    return thumbnail_paths, montage_path
+
+
+# ============================================================================
+# Batch Planning
+# ============================================================================
+
+
+def _share_id_for(url: str) -> str:
+    """Return the share_id used as output subdirectory for a URL."""
+    try:
+        from common_utils import extract_share_id
+    except ImportError:
+        # dicom_download 不可用时（如仅做计划预览），退化为按完整 URL 去重
+        return url
+    return extract_share_id(url)
+
+
+def _load_timings(output_parent: str) -> Dict[str, Dict[str, float]]:
+    """Load per-provider historical timings: {provider: {"count", "avg_seconds"}}."""
+    try:
+        with open(os.path.join(output_parent, _TIMINGS_FILENAME), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _record_timings(output_parent: str, providers: list[str], elapsed: float) -> None:
+    """
+    Fold a finished run into the historical timings.
+
+    The subprocess downloads all URLs in one go and reports no per-URL
+    timings, so a run is only recorded when all its URLs share one
+    provider; mixed runs would blur the per-provider averages.
+    """
+    if not providers or len(set(providers)) != 1:
+        return
+    timings = _load_timings(output_parent)
+    per_url = elapsed / len(providers)
+    for provider in providers:
+        entry = timings.setdefault(provider, {"count": 0, "avg_seconds": 0.0})
+        count = int(entry.get("count", 0)) + 1
+        avg = float(entry.get("avg_seconds", 0.0))
+        entry["count"] = count
+        entry["avg_seconds"] = avg + (per_url - avg) / count
+    try:
+        with open(os.path.join(output_parent, _TIMINGS_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(timings, f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        print(f"[plan] 无法保存耗时记录: {e}", file=sys.stderr)
+
+
+def _parse_expiry(url: str) -> Optional[float]:
+    """Read a link expiry (Unix seconds) from common query parameters."""
+    query = parse_qs(urlparse(url).query)
+    for key in _EXPIRY_QUERY_KEYS:
+        values = query.get(key)
+        if not values:
+            continue
+        try:
+            value = float(values[0])
+        except ValueError:
+            continue
+        # 毫秒时间戳转换为秒
+        if value > 1e12:
+            value /= 1000.0
+        if _EXPIRY_EPOCH_RANGE[0] <= value < _EXPIRY_EPOCH_RANGE[1]:
+            return value
+    return None
+
+
+def build_batch_plan(
+    urls: list[str],
+    output_parent: str,
+    provider: str = "auto",
+    expires_at: Optional[Dict[str, float]] = None,
+) -> BatchPlan:
+    """
+    Group, dedupe and order URLs before execution.
+
+    URLs sharing a share_id are downloaded once. Links with a known expiry
+    run first (soonest first); the rest follow by estimated cost, cheapest
+    first, using per-provider historical timings when available.
+    """
+    timings = _load_timings(output_parent)
+    seen: Dict[str, str] = {}
+    duplicates: list[str] = []
+    candidates = []
+
+    for url in urls:
+        share_id = _share_id_for(url)
+        if share_id in seen:
+            duplicates.append(url)
+            continue
+        seen[share_id] = url
+
+        url_provider = provider if provider != "auto" else detect_provider(url)
+        history = timings.get(url_provider)
+        if history and history.get("count"):
+            cost = float(history["avg_seconds"])
+        else:
+            cost = _DEFAULT_PROVIDER_COST_SECONDS.get(url_provider, 120.0)
+        expiry = (expires_at or {}).get(url)
+        if expiry is None:
+            expiry = _parse_expiry(url)
+        candidates.append((url, url_provider, share_id, cost, expiry))
+
+    # 未过期且有过期时间的优先（越早过期越靠前），其次无过期信息，已过期的最后
+    now = time.time()
+
+    def sort_key(candidate):
+        expiry, cost = candidate[4], candidate[3]
+        if expiry is None:
+            return (1, 0.0, cost)
+        if expiry <= now:
+            return (2, 0.0, cost)
+        return (0, expiry, cost)
+
+    candidates.sort(key=sort_key)
+
+    items = []
+    providers: Dict[str, int] = {}
+    for order, (url, url_provider, share_id, cost, expiry) in enumerate(candidates, 1):
+        providers[url_provider] = providers.get(url_provider, 0) + 1
+        items.append(
+            BatchPlanItem(
+                order=order,
+                url=url,
+                provider=url_provider,
+                share_id=share_id,
+                estimated_seconds=round(cost, 1),
+                expires_at=expiry,
+            )
+        )
+
+    return BatchPlan(
+        items=items,
+        duplicates=duplicates,
+        expired=[c[0] for c in candidates if c[4] is not None and c[4] <= now],
+        providers=providers,
+        estimated_total_seconds=round(sum(item.estimated_seconds for item in items), 1),
+    )
+
+
+def _clean_expires_at(
+    urls: list[str], expires_at: Optional[Dict[str, float]]
+) -> Optional[Dict[str, float]]:
+    """Re-key an expiry mapping by cleaned URL (URL may carry a security code)."""
+    if not expires_at:
+        return None
+    cleaned = {}
+    for url in urls:
+        clean_url, _ = _extract_password_from_url(url)
+        expiry = expires_at.get(clean_url, expires_at.get(url))
+        if expiry is not None:
+            cleaned[clean_url] = expiry
+    return cleaned
+
+
+def _duplicate_results(
+    plan: BatchPlan, results: list[DownloadResult], output_parent: str
+) -> list[DownloadResult]:
+    """Build one result per skipped duplicate, pointing at the kept URL's download."""
+    by_url = {result.url: result for result in results}
+    kept_by_share = {item.share_id: item.url for item in plan.items}
+    duplicate_results = []
+    for url in plan.duplicates:
+        share_id = _share_id_for(url)
+        kept_url = kept_by_share.get(share_id, "")
+        kept = by_url.get(kept_url)
+        success = bool(kept and kept.success)
+        duplicate_results.append(
+            DownloadResult(
+                success=success,
+                url=url,
+                output_dir=kept.output_dir if kept else os.path.join(output_parent, share_id),
+                zip_path=kept.zip_path if kept else None,
+                message=(
+                    f"⏭️ 与 {kept_url} 为同一分享，已复用其下载结果"
+                    if success
+                    else f"❌ 与 {kept_url} 为同一分享，其下载未成功"
+                ),
+                file_count=kept.file_count if kept else None,
+                preview_paths=kept.preview_paths if kept else None,
+                montage_path=kept.montage_path if kept else None,
+            )
+        )
+    return duplicate_results
+
+
+def _order_results(
+    urls: list[str], plan: BatchPlan, results: list[DownloadResult], output_parent: str
+) -> list[DownloadResult]:
+    """
+    Return one result per input URL, in input order.
+
+    Planned URLs take their own result; duplicates take the result built by
+    _duplicate_results. If the run failed as a whole (fewer results than
+    planned URLs), results are returned as-is followed by the duplicates.
+    """
+    duplicate_results = _duplicate_results(plan, results, output_parent)
+    by_url = {result.url: result for result in results}
+    if any(item.url not in by_url for item in plan.items):
+        return results + duplicate_results
+
+    pending_duplicates = iter(duplicate_results)
+    ordered = []
+    used = set()
+    for url in urls:
+        if url in by_url and url not in used:
+            used.add(url)
+            ordered.append(by_url[url])
+        else:
+            ordered.append(next(pending_duplicates))
+    return ordered
+
+
 async def _stream_output(stream, label: str) -> str:
     """Stream subprocess output in real time."""
     output = []
@@ -252,6 +903,8 @@ async def run_multi_download(
     create_zip: bool = True,
     max_rounds: int = 3,
     step_wait_ms: int = 40,
+    dedup: bool = True,
+    generate_preview: bool = True,
 ) -> list[DownloadResult]:
     """
     Run multi_download.py with given parameters.
@@ -261,6 +914,8 @@ async def run_multi_download(
     参数说明：
     - password: [废弃] 全局密码，对所有URL生效
     - passwords: [推荐] URL->密码映射字典，确保一一对应
+    - dedup: 下载后将重复实例硬链接到 output_parent/.dicom_store
+    - generate_preview: 生成各序列缩略图及拼图到 output_parent/<share_id>_preview
     """
 
     script_path = DICOM_DOWNLOAD_PATH / "multi_download.py"
@@ -296,6 +951,7 @@ async def run_multi_download(
             f.write(f"{url}\n")
         urls_file = f.name
 
+    preview_pool = None
     try:
         cmd = [
             sys.executable,
@@ -341,6 +997,7 @@ async def run_multi_download(
         print("", file=sys.stderr)
 
         # Run subprocess with real-time output streaming
+        start_time = time.monotonic()
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
@@ -362,9 +1019,23 @@ async def run_multi_download(
             print("=" * 70, file=sys.stderr)
             print("📊 处理结果中...", file=sys.stderr)
             print("", file=sys.stderr)
+
+            # 记录耗时，供批量计划估算各 provider 成本
+            _record_timings(
+                output_parent,
+                [provider if provider != "auto" else detect_provider(u) for u in urls],
+                time.monotonic() - start_time,
+            )
             
             # Parse output directories from stdout
             results = []
+            store_dir = os.path.join(output_parent, _DEDUP_STORE_DIRNAME)
+            if generate_preview:
+                # 整个批次共用一个进程池；使用 spawn，避免在有线程运行时 fork MCP 服务进程
+                preview_pool = ProcessPoolExecutor(
+                    max_workers=os.cpu_count() or 1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
             for idx, url in enumerate(urls, 1):
                 # Extract share_id and construct output dir
                 from common_utils import extract_share_id
@@ -381,6 +1052,28 @@ async def run_multi_download(
                 )
 
                 print(f"  ✓ 已保存 {file_count} 个文件到: {out_dir}", file=sys.stderr)
+
+                deduplicated_count = None
+                if dedup:
+                    deduplicated_count = await asyncio.to_thread(
+                        dedup_into_store, out_dir, store_dir
+                    )
+                    if deduplicated_count:
+                        print(f"  ♻️  {deduplicated_count} 个重复文件已链接到共享存储", file=sys.stderr)
+
+                preview_paths = None
+                montage_path = None
+                if generate_preview:
+                    try:
+                        preview_paths, montage_path = await generate_previews(
+                            out_dir,
+                            os.path.join(output_parent, f"{share_id}_preview"),
+                            pool=preview_pool,
+                        )
+                        if montage_path:
+                            print(f"  🖼️  已生成 {len(preview_paths)} 个序列预览: {montage_path}", file=sys.stderr)
+                    except Exception as e:
+                        print(f"  ⚠ 预览生成失败: {e}", file=sys.stderr)
                 
                 results.append(
                     DownloadResult(
@@ -390,8 +1083,16 @@ async def run_multi_download(
                         zip_path=zip_path,
                         message=f"✅ 下载成功 ({file_count} 个文件)",
                         file_count=file_count,
+                        deduplicated_count=deduplicated_count,
+                        preview_paths=preview_paths,
+                        montage_path=montage_path,
                     )
                 )
+
+            if dedup:
+                removed = await asyncio.to_thread(gc_dedup_store, store_dir)
+                if removed:
+                    print(f"♻️  已清理 {removed} 个无引用的存储文件", file=sys.stderr)
             
             # Final summary
             total_files = sum(r.file_count or 0 for r in results)
@@ -421,6 +1122,8 @@ async def run_multi_download(
             os.unlink(urls_file)
         except Exception:
             pass
+        if preview_pool is not None:
+            await asyncio.to_thread(preview_pool.shutdown)
 
 
 # ============================================================================
@@ -521,6 +1224,8 @@ async def download_dicom(request: DownloadRequest) -> DownloadResult:
         create_zip=request.create_zip,
         max_rounds=request.max_rounds,
         step_wait_ms=request.step_wait_ms,
+        dedup=request.dedup,
+        generate_preview=request.generate_preview,
     )
     return results[0] if results else DownloadResult(
         success=False,
@@ -539,6 +1244,11 @@ async def batch_download_dicom(request: BatchDownloadRequest) -> list[DownloadRe
     
     Each URL gets its own subdirectory with its corresponding password.
     Supports auto-detection of provider based on domain, or manual provider specification.
+
+    URLs are executed in the order shown by plan_batch (duplicates skipped,
+    soon-to-expire and cheap links first), but results are returned in the
+    order of request.urls, one per URL. A skipped duplicate's result points
+    at the output_dir of the URL that was actually downloaded.
     
     **密码配置方式**（按优先级）：
     1. passwords 字典映射（推荐）：URLs 与密码一一对应
@@ -601,16 +1311,53 @@ async def batch_download_dicom(request: BatchDownloadRequest) -> list[DownloadRe
         )
     
     os.makedirs(request.output_parent, exist_ok=True)
-    return await run_multi_download(
+
+    # ========== 执行计划：去重并排序 ==========
+    plan = build_batch_plan(
         clean_urls,
         request.output_parent,
         provider=request.provider,
+        expires_at=_clean_expires_at(request.urls, request.expires_at),
+    )
+    for url in plan.duplicates:
+        print(f"[batch_download_dicom] 跳过重复分享: {url[:50]}...", file=sys.stderr)
+    planned_urls = [item.url for item in plan.items]
+
+    results = await run_multi_download(
+        planned_urls,
+        request.output_parent,
+        provider=request.provider,
         mode=request.mode,
         headless=request.headless,
         passwords=url_password_dict,
         create_zip=request.create_zip,
         max_rounds=request.max_rounds,
         step_wait_ms=request.step_wait_ms,
+        dedup=request.dedup,
+        generate_preview=request.generate_preview,
+    )
+    return _order_results(clean_urls, plan, results, request.output_parent)
+
+
+@mcp.tool()
+def plan_batch(request: BatchDownloadRequest) -> BatchPlan:
+    """
+    Preview the execution plan of batch_download_dicom without downloading.
+
+    URLs are grouped by provider, duplicates (same share_id) are dropped, and
+    the remaining links are ordered so that soon-to-expire links run first,
+    followed by the cheapest links according to historical timings recorded
+    in output_parent.
+
+    **过期时间**：通过 expires_at={"url": Unix秒} 指定，或从 URL 中的
+    expires/expire_time/exp 等参数自动识别。
+    """
+    clean_urls = [_extract_password_from_url(url)[0] for url in request.urls]
+    return build_batch_plan(
+        clean_urls,
+        request.output_parent,
+        provider=request.provider,
+        expires_at=_clean_expires_at(request.urls, request.expires_at),
     )
 
 
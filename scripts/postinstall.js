@@ -45,6 +45,7 @@ try {
     'httpx>=0.24.0',
     'aiofiles>=23.0.0',
     'pydicom>=2.3.0',
+    'numpy>=1.21.0',
   ];
 
   console.log('Installing required Python packages...');
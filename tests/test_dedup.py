@@ -0,0 +1,111 @@
+"""Tests for the cross-study deduplication store."""
+
+import os
+
+import pytest
+
+pytest.importorskip("mcp")
+
+from dicom_mcp.server import dedup_into_store, gc_dedup_store  # noqa: E402
+
+
+def _blobs(store_dir):
+    return [
+        os.path.join(root, name)
+        for root, dirs, files in os.walk(store_dir)
+        for name in files
+        if not name.endswith(".refs")
+    ]
+
+
+def _make_study(parent, name, unique):
+    series = parent / name / "series"
+    series.mkdir(parents=True)
+    (series / "shared.dcm").write_bytes(b"shared instance")
+    (series / "own.dcm").write_bytes(unique)
+    return str(parent / name)
+
+
+def test_shared_instance_stored_once(tmp_path):
+    store = str(tmp_path / ".dicom_store")
+    study_a = _make_study(tmp_path, "A", b"a")
+    study_b = _make_study(tmp_path, "B", b"b")
+
+    assert dedup_into_store(study_a, store) == 0
+    assert dedup_into_store(study_b, store) == 1
+
+    assert len(_blobs(store)) == 3
+    assert (tmp_path / "B" / "series" / "shared.dcm").read_bytes() == b"shared instance"
+
+
+def test_first_sighting_leaves_study_file_alone(tmp_path):
+    store = str(tmp_path / ".dicom_store")
+    study_a = _make_study(tmp_path, "A", b"a")
+    shared = tmp_path / "A" / "series" / "shared.dcm"
+    mode_before = shared.stat().st_mode
+
+    dedup_into_store(study_a, store)
+
+    assert shared.stat().st_nlink == 1
+    assert shared.stat().st_mode == mode_before
+
+
+def test_gc_keeps_referenced_blobs(tmp_path):
+    store = str(tmp_path / ".dicom_store")
+    study_a = _make_study(tmp_path, "A", b"a")
+    study_b = _make_study(tmp_path, "B", b"b")
+    dedup_into_store(study_a, store)
+    dedup_into_store(study_b, store)
+
+    for name in ("shared.dcm", "own.dcm"):
+        os.unlink(tmp_path / "A" / "series" / name)
+    assert gc_dedup_store(store) == 1  # only A's own instance
+    assert len(_blobs(store)) == 2
+
+    for name in ("shared.dcm", "own.dcm"):
+        os.unlink(tmp_path / "B" / "series" / name)
+    assert gc_dedup_store(store) == 2
+    assert _blobs(store) == []
+    assert not any(name.endswith(".refs") for _, _, files in os.walk(store) for name in files)
+
+
+def test_rerun_is_noop(tmp_path):
+    store = str(tmp_path / ".dicom_store")
+    study_a = _make_study(tmp_path, "A", b"a")
+    study_b = _make_study(tmp_path, "B", b"b")
+    dedup_into_store(study_a, store)
+    dedup_into_store(study_b, store)
+
+    shared_b = tmp_path / "B" / "series" / "shared.dcm"
+    inode_before = shared_b.stat().st_ino
+    blobs_before = sorted(_blobs(store))
+
+    assert dedup_into_store(study_a, store) == 0
+    assert dedup_into_store(study_b, store) == 0
+    assert shared_b.stat().st_ino == inode_before
+    assert sorted(_blobs(store)) == blobs_before
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_malformed_uid_stays_inside_store(tmp_path):
+    pydicom = pytest.importorskip("pydicom")
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    ds.file_meta.MediaStorageSOPInstanceUID = "1.2.3"
+    ds.SOPInstanceUID = "../../escaped"
+    study = tmp_path / "A"
+    study.mkdir()
+    pydicom.dcmwrite(str(study / "1.dcm"), ds, enforce_file_format=True)
+
+    store = tmp_path / "nested" / ".dicom_store"
+    dedup_into_store(str(study), str(store))
+
+    blobs = _blobs(str(store))
+    assert len(blobs) == 1
+    assert "escaped" not in os.path.basename(blobs[0])
+    assert not (tmp_path / "escaped").exists()
@@ -0,0 +1,95 @@
+"""Tests for batch planning (ordering, expiry parsing, historical timings)."""
+
+import time
+
+import pytest
+
+pytest.importorskip("mcp")
+
+from dicom_mcp.server import (  # noqa: E402
+    DownloadResult,
+    _load_timings,
+    _order_results,
+    _parse_expiry,
+    _record_timings,
+    build_batch_plan,
+)
+
+TZ_URL = "https://zlyy.tjmucih.cn/viewer?id=1"
+CLOUD_URL = "https://a.medicalimagecloud.com/viewer?id=2"
+FZ_URL = "https://ylyyx.shdc.org.cn/viewer?id=3"
+
+
+def test_parse_expiry_seconds_and_milliseconds():
+    assert _parse_expiry("https://h/v?expires=1900000000") == 1900000000.0
+    assert _parse_expiry("https://h/v?expire_time=1900000000000") == 1900000000.0
+
+
+def test_parse_expiry_ignores_implausible_values():
+    assert _parse_expiry("https://h/v?exp=7") is None
+    assert _parse_expiry("https://h/v?exp=abc") is None
+    assert _parse_expiry("https://h/v?id=1900000000") is None
+
+
+def test_plan_orders_by_expiry_then_cost(tmp_path):
+    soon = int(time.time()) + 3600
+    later = soon + 3600
+    urls = [
+        TZ_URL,
+        CLOUD_URL,
+        f"{FZ_URL}&expires={later}",
+        f"https://ylyyx.shdc.org.cn/viewer?id=4&expires={soon}",
+    ]
+    plan = build_batch_plan(urls, str(tmp_path))
+
+    assert [item.url for item in plan.items] == [urls[3], urls[2], CLOUD_URL, TZ_URL]
+    assert [item.order for item in plan.items] == [1, 2, 3, 4]
+    assert plan.providers == {"fz": 2, "cloud": 1, "tz": 1}
+    assert plan.expired == []
+
+
+def test_plan_puts_expired_links_last(tmp_path):
+    expired = f"{CLOUD_URL}&expires={int(time.time()) - 60}"
+    plan = build_batch_plan([expired, TZ_URL], str(tmp_path))
+
+    assert [item.url for item in plan.items] == [TZ_URL, expired]
+    assert plan.expired == [expired]
+
+
+def test_plan_drops_duplicates(tmp_path):
+    plan = build_batch_plan([TZ_URL, CLOUD_URL, TZ_URL], str(tmp_path))
+
+    assert [item.url for item in plan.items] == [CLOUD_URL, TZ_URL]
+    assert plan.duplicates == [TZ_URL]
+
+
+def test_plan_uses_recorded_timings(tmp_path):
+    _record_timings(str(tmp_path), ["tz"], 10.0)
+    plan = build_batch_plan([CLOUD_URL, TZ_URL], str(tmp_path))
+
+    assert [item.url for item in plan.items] == [TZ_URL, CLOUD_URL]
+    assert plan.items[0].estimated_seconds == 10.0
+
+
+def test_record_timings_skips_mixed_provider_runs(tmp_path):
+    _record_timings(str(tmp_path), ["tz", "cloud"], 100.0)
+    assert _load_timings(str(tmp_path)) == {}
+
+    _record_timings(str(tmp_path), ["tz", "tz"], 100.0)
+    _record_timings(str(tmp_path), ["tz"], 20.0)
+    assert _load_timings(str(tmp_path)) == {"tz": {"count": 3, "avg_seconds": 40.0}}
+
+
+def test_results_follow_input_order(tmp_path):
+    urls = [TZ_URL, CLOUD_URL, TZ_URL]
+    plan = build_batch_plan(urls, str(tmp_path))
+    results = [
+        DownloadResult(success=True, url=item.url, output_dir=f"out/{item.order}", message="ok")
+        for item in plan.items
+    ]
+
+    ordered = _order_results(urls, plan, results, str(tmp_path))
+
+    assert [result.url for result in ordered] == urls
+    assert ordered[2].output_dir == ordered[0].output_dir
+    assert ordered[2].success
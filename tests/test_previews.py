@@ -0,0 +1,83 @@
+"""Tests for series preview rendering (PNG encoder and windowing)."""
+
+import struct
+import zlib
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pydicom = pytest.importorskip("pydicom")
+pytest.importorskip("mcp")
+
+from pydicom.dataset import Dataset, FileMetaDataset  # noqa: E402
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid  # noqa: E402
+
+from dicom_mcp.server import _render_thumbnail, _write_png  # noqa: E402
+
+
+def _read_png(path):
+    """Decode an 8-bit grayscale PNG written by _write_png, checking CRCs."""
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+
+    pos = 8
+    chunks = {}
+    idat = b""
+    while pos < len(data):
+        (length,) = struct.unpack(">I", data[pos:pos + 4])
+        tag = data[pos + 4:pos + 8]
+        body = data[pos + 8:pos + 8 + length]
+        (crc,) = struct.unpack(">I", data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(tag + body) & 0xFFFFFFFF
+        if tag == b"IDAT":
+            idat += body
+        chunks[tag] = body
+        pos += 12 + length
+    assert b"IEND" in chunks
+
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", chunks[b"IHDR"][:10])
+    assert (bit_depth, color_type) == (8, 0)
+    raw = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, width + 1)
+    assert not raw[:, 0].any()  # filter type None on every row
+    return raw[:, 1:]
+
+
+def _make_instance(path, photometric):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.Rows, ds.Columns = 4, 8
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.WindowCenter, ds.WindowWidth = 128, 256
+    ds.PixelData = np.tile(np.arange(0, 256, 32, dtype=np.uint16), (4, 1)).tobytes()
+    pydicom.dcmwrite(str(path), ds, enforce_file_format=True)
+    return str(path)
+
+
+def test_write_png_roundtrip(tmp_path):
+    image = np.arange(35, dtype=np.uint8).reshape(5, 7)
+    out = tmp_path / "img.png"
+    _write_png(str(out), image)
+    np.testing.assert_array_equal(_read_png(out), image)
+
+
+def test_render_thumbnail_monochrome1_inverts(tmp_path):
+    mono2 = _make_instance(tmp_path / "m2.dcm", "MONOCHROME2")
+    mono1 = _make_instance(tmp_path / "m1.dcm", "MONOCHROME1")
+
+    thumb2 = _render_thumbnail(mono2, str(tmp_path / "m2.png"), 256)
+    thumb1 = _render_thumbnail(mono1, str(tmp_path / "m1.png"), 256)
+
+    assert thumb2.shape == (4, 8)
+    assert thumb2[0, 0] < thumb2[0, -1]
+    assert thumb1[0, 0] > thumb1[0, -1]
+    # 255 - x up to rounding of half-way values
+    assert np.abs(thumb1.astype(int) + thumb2.astype(int) - 255).max() <= 1
+    np.testing.assert_array_equal(_read_png(tmp_path / "m1.png"), thumb1)